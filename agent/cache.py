@@ -0,0 +1,93 @@
+import faiss
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+class ExactCache:
+    def __init__(self, max_size: int = 1024):
+        """
+        LRU cache keyed by a BLAKE2 digest of the normalized text and its context
+        Args:
+            max_size (int): Number of entries kept before evicting the least recently used
+        """
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, text: str, context: bytes = b"") -> Optional[Any]:
+        """Return the value cached for the same text in the same context, or None on a miss"""
+        key = self._key(text, context)
+        with self._lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def insert(self, text: str, value: Any, context: bytes = b""):
+        key = self._key(text, context)
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def _key(self, text: str, context: bytes) -> bytes:
+        # Case and whitespace differences map to the same entry
+        normalized = " ".join(text.lower().split())
+        return hashlib.blake2b(normalized.encode('utf-8') + b"\0" + context, digest_size=16).digest()
+
+class SemanticCache:
+    def __init__(self, embed: Callable[[str], List[float]], threshold: float = 0.95, max_size: int = 512):
+        """
+        LRU cache whose keys are matched by embedding cosine similarity
+        Args:
+            embed (Callable): Function returning the embedding of a text
+            threshold (float): Minimum cosine similarity for a hit
+            max_size (int): Number of entries kept before evicting the least recently used
+        """
+        self.embed = embed
+        self.threshold = threshold
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self.index = None
+        self._next_id = 0
+        # Lookups and inserts can come from the agent's worker threads
+        self._lock = threading.Lock()
+
+    def lookup(self, text: str) -> Optional[Any]:
+        """Return the cached value for the most similar text, or None on a miss"""
+        if not self.entries:
+            return None
+
+        vector = self._normalize(text)
+        with self._lock:
+            scores, ids = self.index.search(vector, 1)
+            entry_id = int(ids[0][0])
+            if entry_id not in self.entries or scores[0][0] < self.threshold:
+                return None
+
+            self.entries.move_to_end(entry_id)
+            return self.entries[entry_id][1]
+
+    def insert(self, text: str, value: Any):
+        vector = self._normalize(text)
+        with self._lock:
+            if self.index is None:
+                # Inner product over unit vectors is cosine similarity
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self.index.add_with_ids(vector, np.array([entry_id], dtype=np.int64))
+            self.entries[entry_id] = (text, value)
+
+            if len(self.entries) > self.max_size:
+                evicted_id, _ = self.entries.popitem(last=False)
+                self.index.remove_ids(np.array([evicted_id], dtype=np.int64))
+
+    def _normalize(self, text: str):
+        vector = np.array([self.embed(text)], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
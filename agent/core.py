@@ -1,14 +1,55 @@
 import re
-from typing import List
-from langchain_core.prompts import ChatPromptTemplate
-from agent.llm import OllamaWrapper
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Generator, Iterator, List
+from agent.llm import get_wrapper
 from agent.memory import MemoryManager
 from agent.tools import WebSearchTool, WikipediaTool
+from agent.cache import ExactCache, SemanticCache
+from agent.prompt import PromptManager
 from datetime import datetime
-from agent.logger import AgentLogger
-from config import Config
+from agent.logger import AgentLogger, attach_script_context, capture_script_context
+from config import CONFIG
 import json
 
+_KEYWORDS_RE = re.compile(r"```(.*)```", re.DOTALL)
+_JSON_BLOCK_RE = re.compile(r'```json\n(.*?)\n```', re.DOTALL)
+# First JSON object in a reply, with or without a ```json fence around it
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+_THINK_RE = re.compile(r'<think>.*?</think>', re.DOTALL)
+_HISTORY_RE = re.compile(
+    r'\b(previous questions|past conversations|history|what did i ask|have we discussed|before)\b',
+    re.IGNORECASE
+)
+
+VALID_SEARCH_TOOLS = ['both', 'web', 'wikipedia', 'llm']
+
+# Inference time grows with prompt length, so retrieved context is capped
+MAX_CTX_CHARS = 4000
+# Memories may use up to this much of the budget, leaving the rest for search results
+MAX_MEMORY_CHARS = MAX_CTX_CHARS // 2
+# Wikipedia summaries are shortened when web results share the context
+WIKI_CHARS_WITH_WEB = 400
+
+# One classifier call replaces separate complexity, history and search-routing prompts
+ROUTER_PROMPT = """Classify this query for an assistant that remembers its conversations:
+        Query: {query}
+
+        Conversation history:
+        {history}
+
+        - "complex": true if the query contains multiple independent questions or requires
+          multiple information sources (different topics, both factual and current information,
+          conjunctions like 'and', 'also', 'plus')
+        - "history": true if the query is asking about conversation history with the agent
+        - "search": 'llm' if the query can be answered without external search, 'web' for general
+          web search, 'wikipedia' for factual/encyclopedic info, 'both' for comprehensive research.
+          If you are unsure or the query looks irrelevant to web search or wikipedia, choose 'llm'.
+
+        Respond in format:
+        ```json
+        {{"complex": false, "history": false, "search": "llm"}}
+        ```"""
+
 class StatefulAgent:
     def __init__(self, agent_id: str):
         self.agent_id = agent_id
@@ -17,45 +58,105 @@ class StatefulAgent:
             'web': WebSearchTool(agent_id),
             'wikipedia': WikipediaTool(agent_id)
         }
-        self.llm_wrapper = OllamaWrapper()
+        self.config = CONFIG
+        self.llm_wrapper = get_wrapper(self.config.model)
         self.llm = self.llm_wrapper.get_llm()
+        self.embeddings = self.llm_wrapper.get_embeddings()
         self.logger = AgentLogger(agent_id)
-        self.config = Config()
+
+        # Semantic caches and memory retrieval share one cached embedding per query text
+        self._embed_query = self.llm_wrapper.embed_query
+        # Answers depend on the conversation so far, so this cache only serves opening messages
+        self.response_cache = SemanticCache(self._embed_query, threshold=0.95, max_size=512)
+        # Checked first and keyed on the conversation digest, so it can never return a reply written for
+        # another context. Committed turns change the digest, so in practice it only hits for repeated
+        # opening messages, where it answers without embedding the query for the semantic cache
+        self.exact_cache = ExactCache(max_size=1024)
+        self.route_cache = SemanticCache(self._embed_query, threshold=0.95, max_size=256)
+        self.search_cache = SemanticCache(self._embed_query, threshold=0.95, max_size=256)
+        self.keyword_cache = SemanticCache(self._embed_query, threshold=0.95, max_size=256)
+
+        # Ollama, SerpAPI and Wikipedia calls are I/O bound, so independent ones run concurrently
+        self._pool = ThreadPoolExecutor(max_workers=8)
+        # The 14B model takes a while to load, so start it before the first message arrives
+        self._pool.submit(self.llm_wrapper.warm_up)
         
-        self.persona = f"""
+        # Kept free of anything that changes over time, since it heads every cached prompt prefix
+        self.persona = """
         You are an adaptive AI assistant that learns from interactions. 
         Your personality evolves based on your experiences.
         
-        Current date: {datetime.now().strftime("%Y-%m-%d")}
         You have access to complete conversation history. 
         When asked about previous interactions, refer to your memory.
         """
+        # Used when the caller does not keep its own per-session conversation
+        self.conversation = self.new_conversation()
+
+    def new_conversation(self) -> PromptManager:
+        return PromptManager(self.persona, summarize=self._summarize_conversation)
 
-    def process_message(self, message: str) -> str:
+    def process_message(self, message: str, conversation: PromptManager = None) -> str:
+        return "".join(self.stream_message(message, conversation)).strip()
+
+    def stream_message(self, message: str, conversation: PromptManager = None) -> Iterator[str]:
+        """Yield the reply in chunks as the LLM generates it"""
+        if conversation is None:
+            conversation = self.conversation
+        response = yield from self._respond(message, conversation)
+        conversation.commit_turn(message, response)
+
+    def _respond(self, message: str, conversation: PromptManager) -> Generator[str, None, str]:
         self.logger.log_activity("message_received", {"query": message})
 
-        if self._is_complex_query(message):
+        conversation_digest = conversation.digest()
+        context_free = not conversation.committed
+        cached = self.exact_cache.lookup(message, conversation_digest)
+        if cached is None and context_free:
+            cached = self.response_cache.lookup(message)
+        if cached is not None:
+            self.logger.log_activity("cache_hit", {"query": message})
+            yield cached
+            # A cached answer is still a turn the agent should remember
+            self.memory.add_memory(
+                experience=f"User: {message}\nAssistant: {cached}",
+                metadata={'type': 'conversation'}
+            )
+            return cached
+
+        # Obvious history questions skip the router call entirely
+        if self._is_about_history(message):
+            self.logger.log_activity("history_query", {"query": message})
+            return (yield from self._handle_history_query(message))
+
+        history = self.memory.retrieve_memories(message, k=10)
+        route = self._route(message, history)
+
+        if route['complex']:
             self.logger.log_activity("complex_query", {"query": message})
-            return self._process_complex_query(message)
+            response = yield from self._process_complex_query(message)
+            self._cache_response(message, conversation_digest, context_free, response)
+            return response
         
-        if self._is_about_history(message):
+        if route['history']:
             self.logger.log_activity("history_query", {"query": message})
-            return self._handle_history_query(message)
+            return (yield from self._handle_history_query(message, history))
         
-        # Retrieve relevant memories
-        context_memories = self.memory.retrieve_memories(message)
-        context = "\n".join([m['experience'] for m in context_memories])
+        # The top five of the routing retrieval are the relevant memories for the answer
+        context_memories = history[:5]
+        context = self._memory_context(context_memories)
         
 
-        search_type = self._determine_search_needs(message)
+        search_type = route['search']
         if search_type == 'llm':
             # LLM-based response
-            response = self.llm.invoke(message).content
-            response = self._postprocess_response(response)
+            response = yield from self._stream_response(
+                conversation.build_messages(message, dynamic_system_prompt=self._turn_context())
+            )
             self.memory.add_memory(
                 experience=f"User: {message}\nDo not ask back any questions, just answer.\n\nAssistant: {response}",
                 metadata={'type': 'conversation'}
             )
+            self._cache_response(message, conversation_digest, context_free, response)
             self.logger.log_activity("response_generated", {"response": response})
             return response
         elif search_type == 'web':
@@ -66,49 +167,51 @@ class StatefulAgent:
             # Wikipedia search
             context += "\nWikipedia Results:\n"
             keywords = self._break_down_query_into_keywords(message)
-            for keyword in keywords:
-                res = self.tools['wikipedia'].search(keyword)
-                context += res
+            context += "".join(self._map(self.tools['wikipedia'].search, keywords))
         elif search_type == 'both':
             # Comprehensive search
             context += "\nWikipedia Results:\n"
-            web_results = self.tools['web'].search(message)
+            web_future = self._submit(self.tools['web'].search, message)
             keywords = self._break_down_query_into_keywords(message)
-            for keyword in keywords:
-                res = self.tools['wikipedia'].search(keyword)
-                context += res
+            context += "".join(self._map(
+                lambda keyword: self.tools['wikipedia'].search(keyword, max_chars=WIKI_CHARS_WITH_WEB),
+                keywords
+            ))
+            web_results = web_future.result()
             context += "\nSearch Results:\n" + "\n".join([r['snippet'] for r in web_results])
 
-        # Generate response
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", self.persona),
-            ("human", "Context:\n{context}\n\nQuery: {query}")
-        ])
-        
-        chain = prompt | self.llm
-        response = chain.invoke({
-            "context": context,
-            "query": message
-        }).content
+        # Generate response; the turn's context goes after the stable persona and history prefix
+        response = yield from self._stream_response(
+            conversation.build_messages(message, dynamic_system_prompt=self._turn_context(context[:MAX_CTX_CHARS]))
+        )
         
-        response = self._postprocess_response(response)
         # Update memory
         self.memory.add_memory(
             experience=f"User: {message}\nAssistant: {response}",
             metadata={'type': 'conversation'}
         )
+        # Answers built on live web results go stale, so they are regenerated on every ask
+        if search_type not in ('web', 'both'):
+            self._cache_response(message, conversation_digest, context_free, response)
         self.logger.log_activity("response_generated", {"response": response})
         return response
     
-    def _process_complex_query(self, query: str) -> str:
+    def _turn_context(self, context: str = "") -> str:
+        # The agent outlives a single day, so the date is read on every turn
+        return f"Current date: {datetime.now().strftime('%Y-%m-%d')}\n{context}".strip()
+
+    def _cache_response(self, message: str, conversation_digest: bytes, context_free: bool, response: str):
+        self.exact_cache.insert(message, response, conversation_digest)
+        # A follow-up like "tell me more" must never be answered with a reply written for another conversation
+        if context_free:
+            self.response_cache.insert(message, response)
+
+    def _process_complex_query(self, query: str) -> Generator[str, None, str]:
         """Handle complex queries by breaking them into sub-queries"""
         sub_queries = self._decompose_query(query)
-        results = []
-        
-        for sub_q in sub_queries:
-            results.append(self._determine_search_needs(sub_q))
+        results = self._map(self._determine_search_needs, sub_queries)
         
-        return self._synthesize_results(query, sub_queries, results)
+        return (yield from self._synthesize_results(query, sub_queries, results))
     
     def _decompose_query(self, query: str) -> List[str]:
         """Break down complex query into sub-questions"""
@@ -122,7 +225,7 @@ class StatefulAgent:
         response = self.llm.invoke(prompt).content
         response = self._postprocess_response(response)
         try:
-            match = re.search(r'```json\n(.*?)\n```', response, re.DOTALL)
+            match = _JSON_BLOCK_RE.search(response)
             if match:
                 return json.loads(match.group(1))['sub_questions']
             return [query]
@@ -130,7 +233,7 @@ class StatefulAgent:
             return [query]
 
 
-    def _synthesize_results(self, original_query: str, sub_queries: List[str], results: List) -> str:
+    def _synthesize_results(self, original_query: str, sub_queries: List[str], results: List) -> Generator[str, None, str]:
         """Combine sub-query results into final answer"""
         context = []
         for q, res in zip(sub_queries, results):
@@ -143,8 +246,7 @@ class StatefulAgent:
         {chr(10).join(context)}
         
         Provide a comprehensive answer that addresses all aspects of the original query."""
-        res = self.llm.invoke(prompt).content
-        res = self._postprocess_response(res)
+        res = yield from self._stream_response(prompt)
         self.logger.log_activity("synthesis", {"query": original_query, "response": res})
         self.memory.add_memory(
             experience=f"User: {original_query}\nAssistant: {res}",
@@ -152,24 +254,54 @@ class StatefulAgent:
         )
         return res
     
-    def _is_complex_query(self, query: str) -> bool:
-        """Determine if query requires decomposition"""
-        prompt = f"""Does this query contain multiple independent questions or require multiple information sources?
-        Query: {query}
-        
-        Consider complex if:
-        - Asks about different topics
-        - Requires both factual and current information
-        - Uses conjunctions like 'and', 'also', 'plus'
+    def _summarize_conversation(self, summary: str, messages: List[Dict]) -> str:
+        """Fold older conversation turns into the running summary kept in the prompt"""
+        transcript = "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in messages)
+        prompt = f"""Update the summary of this conversation with the new messages, keeping names, facts and decisions:
+        Summary so far:
+        {summary or "(empty)"}
         
-        Respond ONLY with 'yes' or 'no'"""
+        New messages:
+        {transcript}
         
-        response = self.llm.invoke(prompt).content.lower().strip()
-        response = self._postprocess_response(response)
-        self.logger.log_activity("complex_query_check", {"query": query, "response": response})
-        return 'yes' in response
+        Respond with the updated summary only."""
+        res = self._postprocess_response(self.llm.invoke(prompt).content)
+        self.logger.log_activity("conversation_summarized", {"messages": len(messages)})
+        return res
+
+    def _route(self, query: str, history: List[Dict]) -> Dict:
+        """Decide in a single LLM call whether the query is complex, about history, and which search to use"""
+        cached = self.route_cache.lookup(query)
+        if cached is not None:
+            return cached
+
+        response = self._classify(ROUTER_PROMPT.format(
+            query=query,
+            history="\n".join(m['experience'] for m in history)
+        ))
+        self.logger.log_activity("route_decision", {"query": query, "response": response})
+
+        route = {'complex': False, 'history': False, 'search': 'llm'}
+        match = _JSON_OBJECT_RE.search(response)
+        try:
+            decision = json.loads(match.group(0))
+            route['complex'] = bool(decision.get('complex', False))
+            route['history'] = bool(history) and bool(decision.get('history', False))
+            search = str(decision.get('search', 'llm')).lower()
+            route['search'] = next((tool for tool in VALID_SEARCH_TOOLS if tool in search), 'llm')
+        except (ValueError, AttributeError) as e:
+            # Fall back to a plain LLM answer, and leave the query uncached so the next ask retries
+            self.logger.log_activity("route_parse_error", {"query": query, "response": response, "error": str(e)})
+            return route
+
+        self.route_cache.insert(query, route)
+        return route
     
     def _break_down_query_into_keywords(self, query: str) -> List[str]:
+        cached = self.keyword_cache.lookup(query)
+        if cached is not None:
+            return cached
+
         prompt = f"""
         Break down the query into keyword or keywords by listing the most important words:
         Query: {query}
@@ -180,11 +312,18 @@ class StatefulAgent:
         
         response = self.llm.invoke(prompt).content
         print("Response: ", response)
-        keywords = re.findall(r"```(.*)```", response, re.DOTALL)
-        return keywords[0].split(", ")
+        keywords = _KEYWORDS_RE.findall(response)
+        # Drop repeated keywords so the same page is not fetched twice in one turn
+        keywords = list(dict.fromkeys(k.strip() for k in keywords[0].split(",") if k.strip()))
+        self.keyword_cache.insert(query, keywords)
+        return keywords
     
     def _determine_search_needs(self, query: str) -> str:
         """Determine which search tools to use based on query"""
+        cached = self.search_cache.lookup(query)
+        if cached is not None:
+            return cached
+
         prompt = f"""Analyze the query and choose search options:
         Query: {query}
         
@@ -200,43 +339,20 @@ class StatefulAgent:
         Choose wikipedia if query has keywords that can be searched on wikipedia.
         If you are unsure or the query looks irrelevant to web search or wikipedia, choose 'llm'.
         Respond in format: 'tool'"""
-        response = self.llm.invoke(prompt).content.lower().strip()
-        response = self._postprocess_response(response)
+        response = self._classify(prompt)
         self.logger.log_activity("search_decision", {"query": query, "response": response})
-        valid_tools = ['both', 'web', 'wikipedia', 'llm']
-        for tool in valid_tools:
-            if tool in response:
-                return tool
-        return response if response in valid_tools else 'llm'
+        search_type = next((tool for tool in VALID_SEARCH_TOOLS if tool in response), 'llm')
+        self.search_cache.insert(query, search_type)
+        return search_type
 
     def _is_about_history(self, query: str) -> bool:
-        history_keywords = [
-            "previous questions", "past conversations", "history",
-            "what did I ask", "have we discussed", "before"
-        ]
-        
-        # First check for obvious keywords
-        if any(kw in query.lower() for kw in history_keywords):
-            return True
-        
-        history = self.memory.retrieve_memories(query, k=10)
-        if not history:
-            return False
-        # Then use LLM for ambiguous cases
-        prompt = f"""Determine if this query is asking about conversation history with an agent:
-        Query: {query}
-        
-        Conversation history:
-        {history}
-        Respond ONLY with 'yes' or 'no'"""
-        
-        response = self.llm.invoke(prompt).content.lower().strip()
-        response = self._postprocess_response(response)
-        return 'yes' in response
+        # Only the obvious keywords; ambiguous cases are decided by _route
+        return _HISTORY_RE.search(query) is not None
 
-    def _handle_history_query(self, query: str) -> str:
-        # Retrieve relevant memories
-        memories = self.memory.retrieve_memories(query, k=10)
+    def _handle_history_query(self, query: str, memories: List[Dict] = None) -> Generator[str, None, str]:
+        # Retrieve relevant memories unless the caller already has them
+        if memories is None:
+            memories = self.memory.retrieve_memories(query, k=10)
         
         # Filter user questions
         user_questions = [
@@ -254,15 +370,15 @@ class StatefulAgent:
             search_results = []
             
             if search_type in ['web', 'both']:
-                web_results = self.tools['web'].search(query)
-                search_results.extend([f"Web: {r['snippet']}" for r in web_results])
+                web_future = self._submit(self.tools['web'].search, query)
                 
             if search_type in ['wikipedia', 'both']:
-                wiki_results = []
                 keywords = self._break_down_query_into_keywords(query)
-                for keyword in keywords:
-                    wiki_results.append(self.tools['wikipedia'].search(query))
+                wiki_results = self._map(self.tools['wikipedia'].search, keywords)
                 search_results.extend([f"Wikipedia: {wiki_results}"])
+
+            if search_type in ['web', 'both']:
+                search_results.extend([f"Web: {r['snippet']}" for r in web_future.result()])
             
             context += "\n\nFresh Search Results:\n" + "\n".join(search_results)
 
@@ -271,12 +387,11 @@ class StatefulAgent:
         User query: {query}
         
         Context from history:
-        {context}
+        {context[:MAX_CTX_CHARS]}
         
         If using search results, verify facts with the context. Respond helpfully:"""
         
-        response = self.llm.invoke(prompt).content
-        response = self._postprocess_response(response)
+        response = yield from self._stream_response(prompt)
         
         self.memory.add_memory(
             experience=f"User: {query}\nAssistant: {response}",
@@ -284,10 +399,65 @@ class StatefulAgent:
         )
         return response
     
+    def _stream_response(self, prompt) -> Generator[str, None, str]:
+        """Yield the visible reply as it streams, holding back any <think> block; returns the full reply"""
+        chunks, pending = [], ''
+        for chunk in self.llm.stream(prompt):
+            if chunks:
+                chunks.append(chunk.content)
+                yield chunk.content
+                continue
+            pending += chunk.content
+            if '<think>' in pending and '</think>' not in pending:
+                continue
+            visible = _THINK_RE.sub('', pending).lstrip()
+            # Wait for the first real text, which may still turn out to open a <think> block
+            if not visible or '<think>'.startswith(visible):
+                continue
+            chunks.append(visible)
+            yield visible
+        if not chunks:
+            visible = _THINK_RE.sub('', pending).strip()
+            chunks.append(visible)
+            yield visible
+        return "".join(chunks).strip()
+
+    def _classify(self, prompt: str) -> str:
+        """Invoke the LLM for a short label, dropping any <think> block and normalizing case once"""
+        content = self.llm.invoke(prompt).content
+        if '<think>' in content:
+            content = _THINK_RE.sub('', content)
+        return content.strip().lower()
+
+    def _memory_context(self, memories: List[Dict]) -> str:
+        """Join whole memories in relevance order until the memory share of the budget is used"""
+        parts, used = [], 0
+        for memory in memories:
+            used += len(memory['experience']) + 1
+            if parts and used > MAX_MEMORY_CHARS:
+                break
+            parts.append(memory['experience'])
+        return "\n".join(parts)[:MAX_MEMORY_CHARS]
+
+    def _submit(self, fn, *args):
+        """Run fn on the thread pool, carrying over the Streamlit script context for activity logging"""
+        ctx = capture_script_context()
+
+        def run():
+            attach_script_context(ctx)
+            return fn(*args)
+
+        return self._pool.submit(run)
+
+    def _map(self, fn, items) -> List:
+        futures = [self._submit(fn, item) for item in items]
+        return [future.result() for future in futures]
+
     def _postprocess_response(self, content):
         if self.config.model == "deepseek-r1:14b":
             # Remove everything between <think> tags
-            cleaned = re.sub(r'<think>(.*?)(</think>)', '', content, flags=re.DOTALL)
-            return cleaned.strip()
+            if '<think>' not in content:
+                return content.strip()
+            return _THINK_RE.sub('', content).strip()
         return content
 
@@ -1,19 +1,57 @@
+import functools
+import logging
+import numpy as np
+import ollama
 from langchain_ollama import OllamaEmbeddings, ChatOllama
-from config import Config
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Query embeddings kept per process; 4096 float32 vectors of 5120 dims is about 80MB
+EMBED_CACHE_SIZE = 4096
 
 class OllamaWrapper:
-    def __init__(self):
-        self.config = Config()
+    def __init__(self, model_name: str = None):
+        self.config = CONFIG
+        self.model_name = model_name or self.config.model
         self.embeddings = OllamaEmbeddings(
-            model=self.config.model,
+            model=self.model_name,
+            base_url=self.config.base_url
         )
         self.llm = ChatOllama(
-            model=self.config.model,
+            model=self.model_name,
+            base_url=self.config.base_url,
+            keep_alive=self.config.keep_alive,
             temperature=0.7
         )
+        # Each embed_query is a round trip to Ollama; repeated texts reuse the result
+        self.embed_query = functools.lru_cache(maxsize=EMBED_CACHE_SIZE)(self._embed_query)
     
     def get_embeddings(self):
         return self.embeddings
     
     def get_llm(self):
-        return self.llm
\ No newline at end of file
+        return self.llm
+
+    def warm_up(self):
+        """Load the model on the Ollama server ahead of the first request"""
+        try:
+            # An empty prompt loads the weights without generating anything
+            ollama.Client(host=self.config.base_url).generate(
+                model=self.model_name,
+                keep_alive=self.config.keep_alive
+            )
+        except Exception as e:
+            logger.warning("Could not warm up %s: %s", self.model_name, e)
+
+    def _embed_query(self, text: str) -> np.ndarray:
+        # float32 arrays take a fraction of the memory of a list of Python floats
+        embedding = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+        # Cached arrays are shared by every caller, so guard them against in-place edits
+        embedding.setflags(write=False)
+        return embedding
+
+@functools.lru_cache(maxsize=4)
+def get_wrapper(model_name: str) -> OllamaWrapper:
+    """Process-wide OllamaWrapper per model, so all components share the same clients"""
+    return OllamaWrapper(model_name)
\ No newline at end of file
@@ -1,9 +1,55 @@
 import logging
 import os
-from datetime import datetime
-from typing import Dict, Any
+import sys
+import threading
+import time
+from typing import Callable, Dict, Any, NamedTuple
 from pathlib import Path
 
+class Activity(NamedTuple):
+    """One entry of the activity sidebar"""
+    timestamp: str
+    type: str
+    content: str
+
+def capture_script_context():
+    """Streamlit script context of the calling thread, or None outside a Streamlit script run"""
+    # Looking in sys.modules avoids importing Streamlit when the agent runs without it
+    if 'streamlit' not in sys.modules:
+        return None
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    return get_script_run_ctx(suppress_warning=True)
+
+def attach_script_context(ctx):
+    """Let the current worker thread write activities to the session that owns ctx"""
+    if ctx is None:
+        return
+    from streamlit.runtime.scriptrunner import add_script_run_ctx
+    add_script_run_ctx(threading.current_thread(), ctx)
+
+def clock_time() -> str:
+    """Local HH:MM:SS for activity entries, without building a datetime or parsing a format string"""
+    now = time.localtime()
+    return f"{now.tm_hour:02d}:{now.tm_min:02d}:{now.tm_sec:02d}"
+
+# Called with every recorded activity from inside its session's script context, e.g. to persist it
+_activity_sink = None
+
+def set_activity_sink(sink: Callable[[Activity], None]):
+    global _activity_sink
+    _activity_sink = sink
+
+def record_activity(activity_type: str, content: str):
+    """Add an entry to the calling session's activity sidebar; a no-op outside Streamlit"""
+    if capture_script_context() is None:
+        return
+    import streamlit as st
+    activity = Activity(clock_time(), activity_type, content)
+    if _activity_sink is not None:
+        _activity_sink(activity)
+    # The sidebar lists activities newest first
+    st.session_state.activities.appendleft(activity)
+
 class AgentLogger:
     _loggers = {}
 
@@ -42,9 +88,8 @@ class AgentLogger:
         self.logger.propagate = False
 
     def log(self, activity_type: str, details: dict):
-        log_message = f"[{activity_type}] {str(details)}"
-        self.logger.info(log_message)
+        self.log_activity(activity_type, details)
 
     def log_activity(self, activity_type: str, details: Dict[str, Any]):
-        log_entry = f"[{activity_type}] {details}"
-        self.logger.info(log_entry)
\ No newline at end of file
+        # Arguments are formatted by logging only if the record is emitted
+        self.logger.info("[%s] %s", activity_type, details)
\ No newline at end of file
@@ -1,32 +1,56 @@
 import faiss
 import json
 import os
+import atexit
 import base64
+import threading
 import numpy as np
 from typing import List, Dict
-from agent.llm import OllamaWrapper
+from agent.llm import get_wrapper
 from datetime import datetime
-import streamlit as st
-from agent.logger import AgentLogger
-from config import Config
+from agent.logger import AgentLogger, record_activity
+from config import CONFIG
+
+# Indices larger than this are rebuilt with 8-bit scalar quantization
+QUANTIZE_THRESHOLD = 1024
+# Initial rows of the embedding arrays, which then double whenever they fill up
+EMBEDDING_CHUNK = 256
+# Number of added memories buffered before the state is written to disk
+SAVE_EVERY = 16
 
 class MemoryManager:
     def __init__(self, agent_id: str):
         self.agent_id = agent_id
-        self.llm_wrapper = OllamaWrapper()
+        self.config = CONFIG
+        self.llm_wrapper = get_wrapper(self.config.model)
         self.embeddings = self.llm_wrapper.get_embeddings()
         self.llm = self.llm_wrapper.get_llm()
         self.logger = AgentLogger(agent_id)
-        self.config = Config()
-        # Memory storage
-        self.short_term_memory: List[Dict] = []
-        self.long_term_memory: List[Dict] = []
+        # The agent can be shared by several Streamlit sessions at once; LLM calls and disk writes
+        # happen outside this lock so they never block another session's retrieval
+        self._lock = threading.RLock()
+        # Keeps two flushes from writing the same files at once
+        self._save_lock = threading.Lock()
+        # Memory storage: metadata dicts plus parallel row-per-memory int8 embeddings and their scales
+        self.short_meta: List[Dict] = []
+        self.long_meta: List[Dict] = []
+        self.short_embs = self._empty_embeddings()
+        self.long_embs = self._empty_embeddings()
+        self.short_scales = self._empty_scales()
+        self.long_scales = self._empty_scales()
         
         # FAISS indices
-        self.short_term_index = faiss.IndexFlatL2(self.config.embed_size) # 4096 is the size of the embeddings for Llama 3.1
-        self.long_term_index = faiss.IndexFlatL2(self.config.embed_size) # 5120 is the size of embeddings for deepseek-r1:14b
+        self.short_term_index = self._new_short_index()
+        self.long_term_index = self._new_index()
+        # Ids of short-term memories not yet folded into a summary
+        self._active_short: List[int] = []
+        # Set while a summary is being generated, so only one runs at a time
+        self._summarizing = False
         
         self._load_state()
+        # Count of memories added since the last save
+        self._dirty = 0
+        atexit.register(self.flush)
 
     def add_memory(self, experience: str, metadata: Dict = None):
         """
@@ -38,8 +62,7 @@ class MemoryManager:
         os.makedirs('data', exist_ok=True)
         memory = {
             'experience': experience,
-            'metadata': metadata or {},
-            'embedding': self._embed(experience)
+            'metadata': metadata or {}
         }
         memory['metadata']['timestamp'] = datetime.now().isoformat()
 
@@ -48,15 +71,41 @@ class MemoryManager:
             "metadata": metadata
         })
         
-        # Add to short-term memory
-        self.short_term_memory.append(memory)
-        self.short_term_index.add(self._to_numpy(memory['embedding']))
-        
-        # Summarization trigger
-        if len(self.short_term_memory) >= 5:
-            self._summarize_memories()
+        embedding = self._to_numpy(self._embed(experience))
+        faiss.normalize_L2(embedding)
+        with self._lock:
+            # Add to short-term memory
+            n_items = len(self.short_meta)
+            self.short_embs = self._ensure_capacity(self.short_embs, n_items + 1)
+            self.short_scales = self._ensure_capacity(self.short_scales, n_items + 1)
+            self.short_embs[n_items:n_items + 1], self.short_scales[n_items:n_items + 1] = self._quantize(embedding)
+            self.short_meta.append(memory)
+            # The row number is the memory's stable id in the short-term index
+            self.short_term_index.add_with_ids(embedding, np.array([n_items], dtype=np.int64))
+            self._active_short.append(n_items)
+            self._dirty += 1
+            
+            # Summarization trigger; the batch stays searchable until its summary is stored
+            batch = None
+            if len(self._active_short) >= 5 and not self._summarizing:
+                self._summarizing = True
+                batch = list(self._active_short)
+                experiences = [self.short_meta[idx]['experience'] for idx in batch]
 
-        self._save_state()
+        if batch is not None:
+            self._summarize_memories(batch, experiences)
+        if self._dirty >= SAVE_EVERY:
+            self.flush()
+
+    def flush(self):
+        """Write pending memories to disk"""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                snapshot = self._snapshot_state()
+                self._dirty = 0
+            self._write_state(snapshot)
 
     def retrieve_memories(self, query: str, k: int = 5) -> List[Dict]:
         """
@@ -69,90 +118,261 @@ class MemoryManager:
         Returns:
             List[Dict]: List of relevant memories"""
             
+        # Check if indices are empty before paying for the query embedding
+        if not self._active_short and self.long_term_index.ntotal == 0:
+            return []
+
         query_embed = self._embed(query)
         query_embed = self._to_numpy(query_embed)
-        memories = []
+        # Stored rows are unit vectors, so L2 ranking matches cosine ranking
+        faiss.normalize_L2(query_embed)
         
-        # Check if indices are empty
-        if self.short_term_index.ntotal == 0 and self.long_term_index.ntotal == 0:
-            return memories
-        
-        # Search both indices
-        _, short_indices = self.short_term_index.search(query_embed, k)
-        _, long_indices = self.long_term_index.search(query_embed, k)
-        
-        for idx in short_indices[0]:
-            if idx != -1:  # Ensure valid index
-                memories.append(self.short_term_memory[idx])
-        for idx in long_indices[0]:
-            if idx != -1:  # Ensure valid index
-                memories.append(self.long_term_memory[idx])
+        with self._lock:
+            # Search both indices; the short-term index only holds unsummarized memories
+            _, short_indices = self.short_term_index.search(query_embed, k)
+            _, long_indices = self.long_term_index.search(query_embed, k)
+            short_indices = short_indices[0][short_indices[0] != -1]  # Ensure valid index
+            long_indices = long_indices[0][long_indices[0] != -1]
+            
+            memories = [self.short_meta[idx] for idx in short_indices] + [self.long_meta[idx] for idx in long_indices]
+            candidates = np.concatenate([self.short_embs[short_indices], self.long_embs[long_indices]])
+            scales = np.concatenate([self.short_scales[short_indices], self.long_scales[long_indices]])
         
-        st.session_state.activities.append({
-            'timestamp': datetime.now().strftime("%H:%M:%S"),
-            'type': 'memory_retrieval',
-            'content': f"Query: {query}\nFound {len(memories)} relevant memories"
-        })
+        record_activity('memory_retrieval', f"Query: {query}\nFound {len(memories)} relevant memories")
             
-        return sorted(memories, key=lambda x: x['metadata'].get('importance', 0), reverse=True)[:k]
-
-    def _summarize_memories(self):
-        # Generate summary using LLM
-        summary = self.llm.invoke(
-            f"Summarize these memories while preserving key details:\n" +
-            "\n".join([m['experience'] for m in self.short_term_memory])
-        ).content
+        importance = np.array([m['metadata'].get('importance', 0) for m in memories], dtype=np.float32)
+        return [memories[idx] for idx in self._rerank(query_embed, candidates, scales, importance, k)]
+
+    def _rerank(self, query_embed: np.ndarray, candidates: np.ndarray, scales: np.ndarray,
+                importance: np.ndarray, k: int) -> np.ndarray:
+        """Order candidates by importance, breaking ties by cosine similarity in one matrix-vector product"""
+        query_codes, query_scale = self._quantize(query_embed)
+        # Integer dot products of the int8 codes, rescaled to the cosine of the original vectors
+        similarity = (candidates.astype(np.int32) @ query_codes[0].astype(np.int32)) * scales * query_scale[0]
+        return np.lexsort((-similarity, -importance))[:k]
+
+    def _summarize_memories(self, batch: List[int], experiences: List[str]):
+        """Fold a snapshot of short-term memories into one long-term summary; called without the lock held"""
+        try:
+            # Generate summary using LLM
+            summary = self.llm.invoke(
+                f"Summarize these memories while preserving key details:\n" +
+                "\n".join(experiences)
+            ).content
+            embedding = self._to_numpy(self.embeddings.embed_documents([summary])[0])
+            faiss.normalize_L2(embedding)
+        except Exception:
+            with self._lock:
+                self._summarizing = False
+            raise
         
         # Create long-term memory entry
         long_term_entry = {
             'experience': summary,
-            'metadata': {'type': 'summary', 'source_count': len(self.short_term_memory)},
-            'embedding': self._embed(summary)
+            'metadata': {'type': 'summary', 'source_count': len(batch)}
         }
         
-        # Add to long-term storage
-        self.long_term_memory.append(long_term_entry)
-        self.long_term_index.add(self._to_numpy(long_term_entry['embedding']))
-        
-        # Clear short-term memory
-        self.short_term_memory.clear()
-        self.short_term_index.reset()
+        with self._lock:
+            # Add to long-term storage
+            n_items = len(self.long_meta)
+            self.long_embs = self._ensure_capacity(self.long_embs, n_items + 1)
+            self.long_scales = self._ensure_capacity(self.long_scales, n_items + 1)
+            self.long_embs[n_items:n_items + 1], self.long_scales[n_items:n_items + 1] = self._quantize(embedding)
+            self.long_meta.append(long_term_entry)
+            self.long_term_index.add(embedding)
+            self.long_term_index = self._maybe_quantize(self.long_term_index)
+            
+            # Drop the summarized vectors from the short-term index; ids of the remaining rows are unchanged
+            # and memories added while the summary was generated stay active
+            summarized = set(batch)
+            for idx in batch:
+                self.short_meta[idx]['metadata']['summarized'] = True
+            self.short_term_index.remove_ids(np.array(batch, dtype=np.int64))
+            self._active_short = [idx for idx in self._active_short if idx not in summarized]
+            self._summarizing = False
+            self._dirty += 1
+
+    def _new_short_index(self):
+        # Only the few unsummarized memories are kept here, so an exact flat scan suffices
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(self.config.embed_size))
+
+    def build_short_index(self, embeddings: np.ndarray):
+        index = self._new_short_index()
+        if len(embeddings):
+            index.add_with_ids(embeddings, np.arange(len(embeddings), dtype=np.int64))
+        return index
+
+    def _new_index(self, quantized: bool = False):
+        # HNSW graph keeps queries O(log n) instead of scanning every stored vector
+        if quantized:
+            # int8 codes use a quarter of the FP32 storage and bandwidth per distance
+            index = faiss.IndexHNSWSQ(self.config.embed_size, faiss.ScalarQuantizer.QT_8bit, 32)
+        else:
+            index = faiss.IndexHNSWFlat(self.config.embed_size, 32) # 4096 for Llama 3.1, 5120 for deepseek-r1:14b
+        index.hnsw.efConstruction = 200
+        index.hnsw.efSearch = 64
+        return index
+
+    def build_index(self, embeddings: np.ndarray):
+        """Build an HNSW index over a contiguous block of embeddings"""
+        quantized = len(embeddings) > QUANTIZE_THRESHOLD
+        index = self._new_index(quantized)
+        if len(embeddings):
+            if quantized:
+                index.train(embeddings)
+            index.add(embeddings)
+        return index
 
-    def _embed(self, text: str) -> List[float]:
-        return self.embeddings.embed_query(text)
+    def _maybe_quantize(self, index):
+        """Switch a growing long-term FP32 index to the quantized layout once it passes the threshold"""
+        if isinstance(index, faiss.IndexHNSWSQ) or index.ntotal <= QUANTIZE_THRESHOLD:
+            return index
+        self.logger.log_activity("index_quantized", {"size": index.ntotal})
+        return self.build_index(self._dequantize(self.long_embs[:index.ntotal], self.long_scales[:index.ntotal]))
+
+    def _empty_embeddings(self) -> np.ndarray:
+        return np.empty((EMBEDDING_CHUNK, self.config.embed_size), dtype=np.int8)
+
+    def _empty_scales(self) -> np.ndarray:
+        return np.empty(EMBEDDING_CHUNK, dtype=np.float32)
+
+    def _ensure_capacity(self, array: np.ndarray, n_rows: int) -> np.ndarray:
+        """Grow a per-memory array geometrically so appends copy each row O(1) times on average"""
+        if n_rows <= len(array):
+            return array
+        capacity = max(len(array), EMBEDDING_CHUNK)
+        while capacity < n_rows:
+            capacity *= 2
+        grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def _filled(self, empty: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        array = self._ensure_capacity(empty, len(rows))
+        array[:len(rows)] = rows
+        return array
+
+    def _quantize(self, embeddings: np.ndarray):
+        """Symmetric per-row int8 codes: each row is approximately codes * scale"""
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(embeddings / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def _dequantize(self, codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * scales[:, None]
+
+    def _embed(self, text: str) -> np.ndarray:
+        return self.llm_wrapper.embed_query(text)
 
     def _to_numpy(self, embedding: List[float]):
         return np.array([embedding], dtype=np.float32)
 
-    def _save_state(self):
-        os.makedirs('data', exist_ok=True)
+    def _snapshot_state(self) -> Dict:
+        """In-memory copy of everything _write_state saves; called with the lock held"""
+        # Vectors live in the FAISS and .npy files; the JSON holds text and metadata
         state = {
-            'short_term': self.short_term_memory,
-            'long_term': self.long_term_memory,
-            'short_index': base64.b64encode(faiss.serialize_index(self.short_term_index)).decode('utf-8'),
-            'long_index': base64.b64encode(faiss.serialize_index(self.long_term_index)).decode('utf-8')
+            'short_term': self.short_meta,
+            'long_term': self.long_meta
+        }
+        n_short, n_long = len(self.short_meta), len(self.long_meta)
+        return {
+            'memory.json': json.dumps(state, default=str),
+            'short.faiss': faiss.serialize_index(self.short_term_index),
+            'long.faiss': faiss.serialize_index(self.long_term_index),
+            'short_codes.npy': self.short_embs[:n_short].copy(),
+            'short_scales.npy': self.short_scales[:n_short].copy(),
+            'long_codes.npy': self.long_embs[:n_long].copy(),
+            'long_scales.npy': self.long_scales[:n_long].copy()
         }
+
+    def _write_state(self, snapshot: Dict):
+        os.makedirs('data', exist_ok=True)
         with open(f'data/{self.agent_id}_memory.json', 'w') as f:
-            json.dump(state, f, default=str)
+            f.write(snapshot['memory.json'])
+        # serialize_index produces the same bytes faiss.write_index would write
+        snapshot['short.faiss'].tofile(f'data/{self.agent_id}_short.faiss')
+        snapshot['long.faiss'].tofile(f'data/{self.agent_id}_long.faiss')
+        for name in ('short_codes', 'short_scales', 'long_codes', 'long_scales'):
+            np.save(f'data/{self.agent_id}_{name}.npy', snapshot[f'{name}.npy'])
 
     def _load_state(self):
         try:
             with open(f'data/{self.agent_id}_memory.json', 'r') as f:
                 state = json.load(f)
                 
-            self.short_term_memory = state['short_term']
-            self.long_term_memory = state['long_term']
+            self.short_meta = state['short_term']
+            self.long_meta = state['long_term']
             
-            self.short_term_index = faiss.deserialize_index(
-                base64.b64decode(state['short_index'].encode('utf-8'))
-            )
-            self.long_term_index = faiss.deserialize_index(
-                base64.b64decode(state['long_index'].encode('utf-8'))
-            )
+            if 'short_index' in state:
+                # Older states embed base64 indices and per-memory embeddings in the JSON
+                for memory in self.short_meta + self.long_meta:
+                    memory.pop('embedding', None)
+                short_index = self._deserialize_index(state['short_index'])
+                long_index = self._deserialize_index(state['long_index'])
+            else:
+                short_index = faiss.read_index(f'data/{self.agent_id}_short.faiss')
+                long_index = faiss.read_index(f'data/{self.agent_id}_long.faiss')
+
+            short_index, short_codes, short_scales = self._load_embeddings(short_index, 'short', self.build_short_index)
+            long_index, long_codes, long_scales = self._load_embeddings(long_index, 'long', self.build_index)
+
+            # Migrate states saved with older index layouts
+            if not isinstance(short_index, faiss.IndexIDMap2):
+                short_index = self.build_short_index(self._dequantize(short_codes, short_scales))
+            if isinstance(long_index, faiss.IndexFlat):
+                long_index = self.build_index(self._dequantize(long_codes, long_scales))
+
+            self.short_embs = self._filled(self._empty_embeddings(), short_codes)
+            self.short_scales = self._filled(self._empty_scales(), short_scales)
+            self.long_embs = self._filled(self._empty_embeddings(), long_codes)
+            self.long_scales = self._filled(self._empty_scales(), long_scales)
+            self.short_term_index = short_index
+            self.long_term_index = self._maybe_quantize(long_index)
+            self._active_short = [
+                idx for idx, memory in enumerate(self.short_meta)
+                if not memory['metadata'].get('summarized')
+            ]
+            # States saved before summarized vectors were removed still carry them in the index
+            summarized = [idx for idx, memory in enumerate(self.short_meta) if memory['metadata'].get('summarized')]
+            if summarized and self.short_term_index.ntotal > len(self._active_short):
+                self.short_term_index.remove_ids(np.array(summarized, dtype=np.int64))
         except FileNotFoundError:
             pass
         except Exception as e:
             print(f"Error loading memory state: {e}")
-            # Initialize empty indices if loading fails
-            self.short_term_index = faiss.IndexFlatL2(self.config.embed_size)
-            self.long_term_index = faiss.IndexFlatL2(self.config.embed_size)
\ No newline at end of file
+            # Initialize empty memory if loading fails
+            self.short_meta, self.long_meta = [], []
+            self.short_term_index = self._new_short_index()
+            self.long_term_index = self._new_index()
+            self._active_short = []
+
+    def _normalize_rows(self, embeddings: np.ndarray) -> bool:
+        """Scale rows to unit length in place; returns True if any row changed"""
+        norms = np.linalg.norm(embeddings, axis=1)
+        if np.allclose(norms, 1, atol=1e-4):
+            return False
+        faiss.normalize_L2(embeddings)
+        return True
+
+    def _load_embeddings(self, index, name: str, rebuild):
+        """Load a store's int8 rows and scales, converting older FP32 states; returns (index, codes, scales)"""
+        prefix = f'data/{self.agent_id}_{name}'
+        if os.path.exists(f'{prefix}_codes.npy'):
+            return index, np.load(f'{prefix}_codes.npy'), np.load(f'{prefix}_scales.npy')
+
+        if os.path.exists(f'{prefix}_embs.npy'):
+            embeddings = np.load(f'{prefix}_embs.npy')
+        else:
+            # States written before the .npy files existed only have vectors in the index
+            embeddings = index.reconstruct_n(0, index.ntotal)
+        # Unnormalized vectors also need their index rebuilt
+        if self._normalize_rows(embeddings):
+            index = rebuild(embeddings)
+        codes, scales = self._quantize(embeddings)
+        return index, codes, scales
+
+    def _deserialize_index(self, encoded: str):
+        return faiss.deserialize_index(
+            np.frombuffer(base64.b64decode(encoded.encode('utf-8')), dtype=np.uint8)
+        )
\ No newline at end of file
@@ -0,0 +1,73 @@
+import hashlib
+from typing import Callable, Dict, List
+
+# Opening messages kept verbatim for the whole conversation
+HEAD_MESSAGES = 4
+# Recent messages kept verbatim; older ones are folded into the summary
+TAIL_MESSAGES = 20
+# Minimum number of overflowing messages before a summarization call is made
+SUMMARIZE_BATCH = 8
+
+class PromptManager:
+    def __init__(self, static_system_prompt: str, summarize: Callable[[str, List[Dict]], str] = None):
+        """
+        Conversation buffer whose message prefix stays byte-identical between turns
+        Args:
+            static_system_prompt (str): System prompt placed first in every request
+            summarize (Callable): Folds messages into the running summary; without it every turn is kept
+        """
+        self.static_system_prompt = static_system_prompt
+        self.summarize = summarize
+        # Completed turns; only ever appended to, except when a batch of the tail is folded into the summary
+        self.head: List[Dict] = []
+        self.summary = ""
+        self.tail: List[Dict] = []
+
+    @property
+    def committed(self) -> List[Dict]:
+        messages = list(self.head)
+        if self.summary:
+            messages.append({'role': 'system', 'content': f"Summary of the earlier conversation:\n{self.summary}"})
+        return messages + self.tail
+
+    def digest(self) -> bytes:
+        """Hash of the committed conversation, so replies cached against it are only reused in the same context"""
+        h = hashlib.blake2b(digest_size=16)
+        for message in self.committed:
+            h.update(f"{message['role']}\0{message['content']}\0".encode('utf-8'))
+        return h.digest()
+
+    def append(self, role: str, content: str):
+        message = {'role': role, 'content': content}
+        if len(self.head) < HEAD_MESSAGES:
+            self.head.append(message)
+        else:
+            self.tail.append(message)
+
+    def commit_turn(self, user_message: str, response: str):
+        self.append('user', user_message)
+        self.append('assistant', response)
+
+    def build_messages(self, user_message: str, dynamic_system_prompt: str = "") -> List[Dict]:
+        """
+        Assemble the request with the per-turn context at the tail, after the cacheable prefix
+        Args:
+            user_message (str): The new user turn
+            dynamic_system_prompt (str): Retrieved memories and search results for this turn only
+        Returns:
+            List[Dict]: Messages in role/content form
+        """
+        self._compact()
+        messages = [{'role': 'system', 'content': self.static_system_prompt}, *self.committed]
+        if dynamic_system_prompt:
+            messages.append({'role': 'system', 'content': f"Context:\n{dynamic_system_prompt}"})
+        messages.append({'role': 'user', 'content': user_message})
+        return messages
+
+    def _compact(self):
+        # Folding in batches changes the prefix once per batch instead of on every turn
+        overflow = len(self.tail) - TAIL_MESSAGES
+        if self.summarize is None or overflow < SUMMARIZE_BATCH:
+            return
+        self.summary = self.summarize(self.summary, self.tail[:overflow])
+        self.tail = self.tail[overflow:]
@@ -1,15 +1,18 @@
 import requests
 import os
+import functools
+import time
 from wikipediaapi import Wikipedia
 from dotenv import load_dotenv
 import serpapi
-import streamlit as st
-from datetime import datetime
-from agent.logger import AgentLogger
+from agent.logger import AgentLogger, record_activity
 
 
 load_dotenv()
 
+# Web results go stale, so a cached search is reused for at most this many seconds
+WEB_CACHE_TTL = 15 * 60
+
 class WikipediaTool:
     def __init__(self, agent_id: str):
         self.logger = AgentLogger(agent_id)
@@ -17,29 +20,34 @@ class WikipediaTool:
             user_agent="StatefulAgent/1.0 (https://github.com/reddheeraj)",
             language='en'
         )
+        # One Wikipedia request per distinct page title for the life of the process
+        self._page_summary = functools.lru_cache(maxsize=256)(self._fetch_summary)
     
-    def search(self, query: str) -> list:
+    def search(self, query: str, max_chars: int = 1000) -> list:
         """Search Wikipedia and return summaries of relevant pages"""
         self.logger.log_activity("wikipedia_search", {"query": query})
-        page = self.wiki.page(query)
-        if not page:
-            return []
-        
-        results = page.summary[:1000] # limiting to 1000 characters for now
-        st.session_state.activities.append({
-            'timestamp': datetime.now().strftime("%H:%M:%S"),
-            'type': 'wikipedia_search',
-            'content': f"Query: {query}\nFound result: {(results[:100])}"
-        })
+        results = self._page_summary(query.strip())[:max_chars]
+        record_activity('wikipedia_search', f"Query: {query}\nFound result: {(results[:100])}")
         return results
 
+    def _fetch_summary(self, title: str) -> str:
+        return self.wiki.page(title).summary
+
 class WebSearchTool:
     def __init__(self, agent_id: str):
         self.logger = AgentLogger(agent_id)
         self.api_key = os.getenv('SERPAPI_KEY')
+        # SerpAPI is the slowest call in most turns; repeated searches reuse the parsed results
+        self._cached_search = functools.lru_cache(maxsize=256)(self._fetch_results)
     
     def search(self, query, num_results=5):
         self.logger.log_activity("web_search", {"query": query, "num_results": num_results})
+        # The TTL window number is part of the cache key, so entries from an earlier window are never hit
+        results = self._cached_search(query, num_results, int(time.time() // WEB_CACHE_TTL))
+        record_activity('web_search', f"Query: {query}\nFound {len(results)} results")
+        return results
+
+    def _fetch_results(self, query, num_results, window=None):
         params = {
             'q': query,
             'api_key': self.api_key,
@@ -49,12 +57,6 @@ class WebSearchTool:
         search = serpapi.search(params)
         results = dict(search)
         # response = requests.get('https://serpapi.com/search', params=params)
-
-        st.session_state.activities.append({
-            'timestamp': datetime.now().strftime("%H:%M:%S"),
-            'type': 'web_search',
-            'content': f"Query: {query}\nFound {len(results)} results"
-        })
         return self._parse_results(results)
 
     def _parse_results(self, results):
@@ -1,29 +1,154 @@
 import streamlit as st
-from agent.core import StatefulAgent
+from agent.logger import Activity, attach_script_context, capture_script_context, record_activity, set_activity_sink
+from session_store import SessionStore
+from concurrent.futures import ThreadPoolExecutor
 import os
-from datetime import datetime
+import html
+import uuid
+import queue
+import threading
+import collections
+import itertools
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    from agent.core import StatefulAgent
+
+# Per-session buffers keep only the most recent entries; older ones stay in the session store
+HISTORY_LIMIT = 50
+ACTIVITY_LIMIT = 500
+# Entries read from the store on startup and per "load older" click
+LOAD_LIMIT = 50
+
+class HistMsg(NamedTuple):
+    """A chat message and its row id in the session store"""
+    role: str
+    content: str
+    id: int
+
+@st.cache_resource
+def get_agent(name: str) -> "StatefulAgent":
+    # One agent (LLM clients, memory indices) per process, shared by every session;
+    # importing here keeps faiss and langchain out of the script until the first run needs them
+    from agent.core import StatefulAgent
+    return StatefulAgent(name)
+
+@st.cache_resource
+def get_store() -> SessionStore:
+    return SessionStore()
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    # Generation threads shared by every session
+    return ThreadPoolExecutor(max_workers=4)
+
+def stream_in_background(message: str):
+    """Generate the reply on a worker thread and yield its chunks to the script thread as they arrive"""
+    agent, conversation = st.session_state.agent, st.session_state.conversation
+    generation_lock = st.session_state.generation_lock
+    chunks = queue.Queue()
+    cancelled = threading.Event()
+    ctx = capture_script_context()
+
+    def produce():
+        # The worker records activities into this session's sidebar
+        attach_script_context(ctx)
+        # Wait for an abandoned generation of this session to stop before touching its conversation
+        with generation_lock:
+            stream = agent.stream_message(message, conversation)
+            try:
+                while not cancelled.is_set():
+                    chunk = next(stream, None)
+                    if chunk is None:
+                        break
+                    chunks.put(chunk)
+            finally:
+                # Closing an unfinished stream skips its memory and conversation updates
+                stream.close()
+                chunks.put(None)
+
+    future = get_executor().submit(produce)
+    try:
+        while (chunk := chunks.get()) is not None:
+            yield chunk
+    finally:
+        # Runs when the script run is stopped mid-stream, e.g. by a new message
+        cancelled.set()
+    # Re-raise anything the worker failed with
+    future.result()
 
 def initialize_agent():
     if 'agent' not in st.session_state:
-        st.session_state.agent = StatefulAgent("first_agent")
+        st.session_state.agent = get_agent("first_agent")
+    if 'generation_lock' not in st.session_state:
+        st.session_state.generation_lock = threading.Lock()
+    if 'session_id' not in st.session_state:
+        # Never exposed in the URL, so a session's stored transcript cannot be reopened from a shared link
+        st.session_state.session_id = uuid.uuid4().hex
+        st.session_state.older = 0
+    set_activity_sink(persist_activity)
+    store = get_store()
     if 'history' not in st.session_state:
-        st.session_state.history = []
+        recent = store.load(st.session_state.session_id, 'history', LOAD_LIMIT)
+        st.session_state.history = collections.deque(
+            (HistMsg(**row) for row in reversed(recent)), maxlen=HISTORY_LIMIT
+        )
+        # The agent is shared, so each session keeps its own prompt buffer
+        st.session_state.conversation = st.session_state.agent.new_conversation()
+        for msg in st.session_state.history:
+            st.session_state.conversation.append(msg.role, msg.content)
     if 'activities' not in st.session_state:
-        st.session_state.activities = []
+        # Newest first; appendleft on a full deque drops the oldest entry
+        recent = store.load(st.session_state.session_id, 'activity', LOAD_LIMIT)
+        st.session_state.activities = collections.deque(
+            (Activity(row['timestamp'], row['type'], row['content']) for row in recent), maxlen=ACTIVITY_LIMIT
+        )
+
+def persist_activity(activity: Activity):
+    # Agent-side activities arrive here too, from worker threads carrying this session's context
+    get_store().append(st.session_state.session_id, 'activity', activity._asdict())
 
 def log_activity(activity_type: str, content: str):
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    st.session_state.activities.insert(0, {
-        'timestamp': timestamp,
-        'type': activity_type,
-        'content': content
-    })
+    record_activity(activity_type, content)
+
+def add_to_history(role: str, content: str):
+    row_id = get_store().append(st.session_state.session_id, 'history', {'role': role, 'content': content})
+    st.session_state.history.append(HistMsg(role, content, row_id))
+
+def load_older():
+    st.session_state.older += LOAD_LIMIT
+
+def display_history():
+    history = st.session_state.history
+    older = []
+    if history:
+        # Messages before the in-memory window are read back from the store only while shown
+        older = [HistMsg(**row) for row in get_store().load(
+            st.session_state.session_id, 'history', st.session_state.older + 1, before_id=history[0].id
+        )]
+    if len(older) > st.session_state.older:
+        st.button("Load older messages", on_click=load_older)
+    for msg in itertools.chain(reversed(older[:st.session_state.older]), history):
+        with st.chat_message(msg.role):
+            st.markdown(msg.content)
+
+def activity_html(activities) -> str:
+    """One HTML block of collapsible entries, which renders far faster than an expander widget per activity"""
+    return "".join(
+        f"<details><summary>{html.escape(a.timestamp)} - {html.escape(a.type)}</summary>"
+        f"<div style='white-space: pre-wrap; font-size: 0.85em'>{html.escape(str(a.content))}</div></details>"
+        for a in activities
+    )
 
 def display_activity():
     st.sidebar.subheader("Agent Activity Log")
-    for activity in st.session_state.activities[:20]:  # Show last 20 activities
-        with st.sidebar.expander(f"{activity['timestamp']} - {activity['type']}"):
-            st.caption(activity['content'])
+    shown = list(itertools.islice(st.session_state.activities, 20))  # Show last 20 activities
+    # Rebuild the block only when the shown activities change; kept per session so logs never cross sessions
+    fingerprint = tuple((a.timestamp, a.type, len(str(a.content))) for a in shown)
+    if st.session_state.get('activity_fingerprint') != fingerprint:
+        st.session_state.activity_fingerprint = fingerprint
+        st.session_state.activity_block = activity_html(shown)
+    st.sidebar.markdown(st.session_state.activity_block, unsafe_allow_html=True)
 
 def main():
     st.title("Stateful Agent")
@@ -33,27 +158,26 @@ def main():
     # col1, col2 = st.columns([3, 1])
 
     # with col1:  # Main chat column
+    # Display chat history
+    display_history()
+
     user_input = st.chat_input("Message the agent...")
     if user_input:
-        # Add user message to history
-        st.session_state.history.append({'role': 'user', 'content': user_input})
+        # Render the new turn in place rather than rerunning the whole script
+        with st.chat_message('user'):
+            st.markdown(user_input)
         log_activity('user_input', user_input)
         
         # Get agent response
-        with st.spinner("Thinking..."):
-            response = st.session_state.agent.process_message(user_input)
-        
-        # Add agent response to history
-        st.session_state.history.append({'role': 'assistant', 'content': response})
+        with st.chat_message('assistant'):
+            with st.spinner("Thinking..."):
+                # Tokens are shown as they arrive; write_stream returns the full reply
+                response = st.write_stream(stream_in_background(user_input))
         log_activity('agent_response', response)
 
-        # Rerun to update display
-        st.rerun()
-
-    # Display chat history
-    for msg in st.session_state.history:
-        with st.chat_message(msg['role']):
-            st.markdown(msg['content'])
+        # Add both messages to history for the next rerun
+        add_to_history('user', user_input)
+        add_to_history('assistant', response)
 
     # with col2:  # Sidebar activity column
     display_activity()
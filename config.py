@@ -1,5 +1,13 @@
+from dataclasses import dataclass
+
+@dataclass(frozen=True, slots=True)
 class Config:
-    def __init__(self):
-        self.model = "deepseek-r1:14b"
-        self.embedding_model = "nomic-embed-text"
-        self.embed_size = 5120
\ No newline at end of file
+    model: str = "deepseek-r1:14b"
+    embedding_model: str = "nomic-embed-text"
+    embed_size: int = 5120
+    base_url: str = "http://localhost:11434"
+    # How long Ollama keeps the model loaded after the last request
+    keep_alive: str = "1h"
+
+# Read-only settings shared by every module, thread and session
+CONFIG = Config()
\ No newline at end of file
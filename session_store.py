@@ -0,0 +1,63 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List
+
+class SessionStore:
+    def __init__(self, path: str = 'data/sessions.db'):
+        """
+        Append-only SQLite log of per-session chat history and activities
+        Args:
+            path (str): Database file, created if missing
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # One connection is shared by every session's script thread
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            # WAL lets reads proceed during writes; NORMAL skips the fsync on every commit
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_session ON entries (session_id, kind, id)")
+            self.conn.commit()
+
+    def append(self, session_id: str, kind: str, entry: Dict) -> int:
+        """Store an entry and return its id, which orders entries within a session"""
+        with self._lock:
+            cursor = self.conn.execute(
+                "INSERT INTO entries (session_id, kind, payload) VALUES (?, ?, ?)",
+                (session_id, kind, json.dumps(entry))
+            )
+            self.conn.commit()
+            return cursor.lastrowid
+
+    def load(self, session_id: str, kind: str, limit: int, before_id: int = None) -> List[Dict]:
+        """
+        Fetch the latest entries of one kind, newest first
+        Args:
+            session_id (str): Session to read
+            kind (str): Entry kind, e.g. 'history' or 'activity'
+            limit (int): Maximum number of entries
+            before_id (int): Only return entries older than this id
+        Returns:
+            List[Dict]: Stored entries, each with its 'id' added
+        """
+        query = "SELECT id, payload FROM entries WHERE session_id = ? AND kind = ?"
+        params = [session_id, kind]
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(before_id)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [{'id': row_id, **json.loads(payload)} for row_id, payload in rows]